@@ -23,6 +23,11 @@ async def main():
         default=100
         )
 
+    parser.add_argument(
+        "--n", type=int,
+        default=1,
+        help="number of measurements to insert. Default: %(default)s")
+
 
     try:
         args = parser.parse_args()
@@ -46,14 +51,18 @@ async def main():
                 )
 
     async with await connection() as conn:
-        accuracy = random.randint(2, 8)
-        lat = round(random.uniform(6.734, 6.735), 6)
-        lon = round(random.uniform(-72.77, -72.773), 6)
-        pos = (lat, lon)
-        batt_cap = args.batt_cap - random.randint(0, 20)
-        t = datetime.utcnow()
+        rows = []
+        for _ in range(args.n):
+            accuracy = random.randint(2, 8)
+            lat = round(random.uniform(6.734, 6.735), 6)
+            lon = round(random.uniform(-72.77, -72.773), 6)
+            pos = (lat, lon)
+            batt_cap = args.batt_cap - random.randint(0, 20)
+            t = datetime.utcnow()
+            rows.append((args.id, t, pos, accuracy,
+                         3.6, batt_cap, 20, 0, 0, 7))
 
-        sql = f'''
+        sql = '''
             INSERT INTO meas
             (
                 deveui,
@@ -67,21 +76,9 @@ async def main():
                 snr,
                 sf
             )
-            VALUES
-            (
-                {args.id},
-                '{t}',
-                '{pos}',
-                {accuracy},
-                3.6,
-                {batt_cap},
-                '20', 
-                '0',
-                '0',
-                '7'
-            );
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10);
             '''
-        await conn.execute(sql)
+        await conn.executemany(sql, rows)
 
 
 if __name__ == '__main__':
@@ -14,6 +14,9 @@ CREATE TABLE IF NOT EXISTS meas(
     sf                  INT
 );
 
+-- latest measurements per device (DISTINCT ON (deveui) ... ORDER BY deveui, t DESC)
+CREATE INDEX IF NOT EXISTS meas_deveui_t_desc ON meas(deveui, t DESC);
+
 -- +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 CREATE TABLE IF NOT EXISTS trackers(
     deveui               INT NOT NULL PRIMARY KEY,
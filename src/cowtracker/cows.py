@@ -1,14 +1,17 @@
 import asyncio
 from asyncpg import Connection, Record
+from asyncpg.pool import Pool
 from datetime import datetime
 from enum import Enum, auto
-from geopy.distance import distance as geodist
 import logging
+import math
+import time
+import numpy as np
 from pytz import timezone
-from typing import Any, Dict, List, Mapping, Optional
+from typing import Any, Dict, List, Mapping, Optional, Tuple
 
 
-from cowtracker.db import connection
+from cowtracker.db import pool
 from cowtracker.email import Email
 
 logger = logging.getLogger("cows")
@@ -20,11 +23,36 @@ _BATT_V_WARN = None
 _BATT_CAP_WARN = None
 _BATT_CAP_DANGER = None
 _REF_POS = None
+_REF_LAT_RAD = None
+_REF_LON_RAD = None
+_COS_REF_LAT = None
 _DIST_M_WARN = None
 _DIST_M_DANGER = None
 _TIME_S_WARN = None
 _TIME_S_DANGER = None
 _TZ = timezone('America/Bogota')
+_EARTH_RADIUS_M = 6371000
+
+# meas columns read by _PointRecord, time and position are converted to scalars by the db
+_MEAS_COLUMNS = '''
+    deveui, extract(epoch from t)::float8 AS ts, pos[0] AS lat, pos[1] AS lon,
+    accuracy, batt_v, batt_cap, temp, rssi, snr, sf
+'''
+# subset of _MEAS_COLUMNS needed to compare positions
+_POS_COLUMNS = '''
+    extract(epoch from t)::float8 AS ts, pos[0] AS lat, pos[1] AS lon, accuracy
+'''
+
+
+def _squared_meters(p1: Tuple[float, float], p2: Tuple[float, float]) -> float:
+    """ Squared distance in meters between two nearby (lat, lon) positions
+
+    Equirectangular approximation, accurate for the short distances between consecutive points
+    """
+    lat0 = math.radians((p1[0] + p2[0])/2)
+    dx = math.radians(p2[1] - p1[1])*math.cos(lat0)*_EARTH_RADIUS_M
+    dy = math.radians(p2[0] - p1[0])*_EARTH_RADIUS_M
+    return dx*dx + dy*dy
 
 
 def set_warn_levels(warn_levels):
@@ -33,6 +61,9 @@ def set_warn_levels(warn_levels):
     global _BATT_CAP_WARN
     global _BATT_CAP_DANGER
     global _REF_POS
+    global _REF_LAT_RAD
+    global _REF_LON_RAD
+    global _COS_REF_LAT
     global _DIST_M_WARN
     global _DIST_M_DANGER
     global _TIME_S_WARN
@@ -43,6 +74,9 @@ def set_warn_levels(warn_levels):
     _BATT_CAP_WARN = warn_levels['batt_cap_warn']
     _BATT_CAP_DANGER = warn_levels['batt_cap_danger']
     _REF_POS = warn_levels['ref_pos']
+    _REF_LAT_RAD = math.radians(_REF_POS[0])
+    _REF_LON_RAD = math.radians(_REF_POS[1])
+    _COS_REF_LAT = math.cos(_REF_LAT_RAD)
     _DIST_M_WARN = warn_levels['dist_m_warn']
     _DIST_M_DANGER = warn_levels['dist_m_danger']
     _TIME_S_WARN = 3600*warn_levels['time_h_warn']
@@ -64,6 +98,8 @@ class _WarningVariant(Enum):
 
 
 class _Warning():
+    __slots__ = ('code', 'variant', 'value', '_code_v', '_variant_v')
+
     def __init__(self,
                  code: _WarningType,
                  variant: _WarningVariant,
@@ -71,11 +107,13 @@ class _Warning():
         self.code = code
         self.variant = variant
         self.value = value
+        self._code_v = code.value
+        self._variant_v = variant.value
 
     def to_json(self):
         return {
-            'code': self.code.value,
-            'variant': self.variant.value,
+            'code': self._code_v,
+            'variant': self._variant_v,
             'value': self.value
         }
 
@@ -84,8 +122,7 @@ class _Warning():
             return f"Batería baja: {self.value[0]}V ({self.value[1]}%)"
 
         if self.code == _WarningType.NO_MSG_RECV:
-            t: datetime = datetime.fromtimestamp(self.value)
-            t.astimezone(_TZ).strftime("%H:%M:%S %d-%m")
+            t = datetime.fromtimestamp(self.value, _TZ).strftime("%H:%M:%S %d-%m")
 
             return f"No envía mensajes desde las {t}"
 
@@ -100,95 +137,90 @@ class _PointRecord():
 
     @property
     def localtime(self):
-        t: datetime = self._data['t']
-        return t.astimezone(_TZ)
+        return datetime.fromtimestamp(self._data['ts'], _TZ)
 
     @property
     def timestamp(self):
-        t = self._data['t']
-        return t.timestamp()
+        return self._data['ts']
 
     @property
     def point(self):
-        pos_ = self._data['pos']
-        return (pos_.x, pos_.y)
+        return (self._data['lat'], self._data['lon'])
+
+    @property
+    def deveui(self):
+        return self._data['deveui']
 
     @property
     def accuracy(self):
         return self._data['accuracy']
 
-    def get_warnings(self, to_json: Optional[bool] = True) -> List[_Warning]:
-        t = self._data['t']
-        batt_V = self._data['batt_v']
-        batt_cap = self._data['batt_cap']
+    @property
+    def batt_v(self):
+        return self._data['batt_v']
+
+    @property
+    def batt_cap(self):
+        return self._data['batt_cap']
+
+    def get_warnings(self,
+                     to_json: Optional[bool] = True,
+                     dist_m: Optional[float] = None,
+                     now_ts: Optional[float] = None,
+                     flags: Optional[int] = None) -> List[_Warning]:
+        """ Warnings of this record
+
+        flags can be given when they were already computed with _points_warning_flags
+        """
+        if dist_m is None:
+            dist_m = float(Cows._point_distances_to_ref([self])[0])
+        if flags is None:
+            flags = int(_points_warning_flags([self], [dist_m], now_ts)[0])
+
         warns: List[Dict] = []
         self.status = _WarningVariant.INFO
+        if not flags:
+            return warns
 
-        # low battery warning
-        if (batt_V < _BATT_V_NORMAL and batt_V > _BATT_V_WARN) or\
-                (batt_cap < _BATT_CAP_WARN and batt_cap > _BATT_CAP_DANGER):
-            w = _Warning(_WarningType.BATT_LOW,
-                         _WarningVariant.WARNING, (batt_V, batt_cap))
-            warns.append(w.to_json() if to_json else w)
-            self.status = _WarningVariant.WARNING
-
-        if batt_V < _BATT_V_WARN or batt_cap < _BATT_CAP_DANGER:
-            w = _Warning(_WarningType.BATT_LOW,
-                         _WarningVariant.DANGER, (batt_V, batt_cap))
-            warns.append(w.to_json() if to_json else w)
-            self.status = _WarningVariant.WARNING
-
-        # check if device is not sending data
-        now = datetime.utcnow()
-        deltaT = now.timestamp() - t.timestamp()
-        if deltaT > _TIME_S_WARN and deltaT < _TIME_S_DANGER:
-            w = _Warning(_WarningType.NO_MSG_RECV,
-                         _WarningVariant.WARNING, t.timestamp())
-            warns.append(w.to_json() if to_json else w)
-            self.status = _WarningVariant.WARNING
-
-        if deltaT > _TIME_S_DANGER:
-            w = _Warning(_WarningType.NO_MSG_RECV,
-                         _WarningVariant.DANGER, t.timestamp())
-            warns.append(w.to_json() if to_json else w)
-            self.status = _WarningVariant.WARNING
-
-        # check if cow is too far away from reference point
-        dist2ref = geodist(self.point, _REF_POS).meters
-        if dist2ref > _DIST_M_WARN and dist2ref < _DIST_M_DANGER:
-            w = _Warning(_WarningType.COW_TOO_FAR,
-                         _WarningVariant.WARNING, int(dist2ref))
-            warns.append(w.to_json() if to_json else w)
-            self.status = _WarningVariant.WARNING
-
-        if dist2ref > _DIST_M_DANGER:
-            w = _Warning(_WarningType.COW_TOO_FAR,
-                         _WarningVariant.DANGER, int(dist2ref))
-            warns.append(w.to_json() if to_json else w)
-            self.status = _WarningVariant.DANGER
+        values = {
+            _WarningType.BATT_LOW: (self.batt_v, self.batt_cap),
+            _WarningType.NO_MSG_RECV: self.timestamp,
+            _WarningType.COW_TOO_FAR: int(dist_m),
+        }
+        for flag, code, variant, code_v, variant_v in _WARNING_FLAGS:
+            if flags & flag:
+                if to_json:
+                    warns.append({'code': code_v, 'variant': variant_v, 'value': values[code]})
+                else:
+                    warns.append(_Warning(code, variant, values[code]))
 
+        self.status = _WarningVariant.DANGER if flags & _W_TOO_FAR_DANGER else _WarningVariant.WARNING
         return warns
 
     def to_json(self,
                 name: Optional[str] = None,
                 include_warnings: Optional[bool] = True,
-                no_mov_warn: Optional[_Warning] = None) -> Dict:
-        point: Dict = {}
-        for key, value in self._data.items():
-            if key == 'pos':
-                point[key] = {'lat': value.x, 'lon': value.y}
-            elif key == 't':
-                t = value
-                t = value.timestamp()
-                point[key] = t
-            elif key != 'id' and key != 'deveui':
-                point[key] = value
+                no_mov_warn: Optional[_Warning] = None,
+                dist_m: Optional[float] = None,
+                flags: Optional[int] = None) -> Dict:
+        data = self._data
+        point: Dict = {
+            't': data['ts'],
+            'pos': {'lat': data['lat'], 'lon': data['lon']},
+            'accuracy': data['accuracy'],
+            'batt_v': data['batt_v'],
+            'batt_cap': data['batt_cap'],
+            'temp': data['temp'],
+            'rssi': data['rssi'],
+            'snr': data['snr'],
+            'sf': data['sf'],
+        }
 
         if name is not None:
             point['name'] = name
 
         if include_warnings:
-            warns = self.get_warnings()
+            warns = self.get_warnings(dist_m=dist_m, flags=flags)
             if no_mov_warn:
                 self.status = _WarningVariant.DANGER
                 warns.append(no_mov_warn.to_json())
@@ -199,6 +231,62 @@ class _PointRecord():
         return point
 
 
+# warning bits computed by _warning_flags
+_W_BATT_WARN = 1 << 0
+_W_BATT_DANGER = 1 << 1
+_W_NO_MSG_WARN = 1 << 2
+_W_NO_MSG_DANGER = 1 << 3
+_W_TOO_FAR_WARN = 1 << 4
+_W_TOO_FAR_DANGER = 1 << 5
+
+# (bit, code, variant, code.value, variant.value) in the order warnings are reported
+_WARNING_FLAGS = tuple((flag, code, variant, code.value, variant.value) for flag, code, variant in (
+    (_W_BATT_WARN, _WarningType.BATT_LOW, _WarningVariant.WARNING),
+    (_W_BATT_DANGER, _WarningType.BATT_LOW, _WarningVariant.DANGER),
+    (_W_NO_MSG_WARN, _WarningType.NO_MSG_RECV, _WarningVariant.WARNING),
+    (_W_NO_MSG_DANGER, _WarningType.NO_MSG_RECV, _WarningVariant.DANGER),
+    (_W_TOO_FAR_WARN, _WarningType.COW_TOO_FAR, _WarningVariant.WARNING),
+    (_W_TOO_FAR_DANGER, _WarningType.COW_TOO_FAR, _WarningVariant.DANGER),
+))
+
+
+def _warning_flags(batt_v: np.ndarray,
+                   batt_cap: np.ndarray,
+                   delta_t: np.ndarray,
+                   dist_m: np.ndarray) -> np.ndarray:
+    """ Evaluates the warning thresholds over arrays of records
+
+    Returns one uint8 bitmask of _W_* bits per record. Missing values (NaN) do not raise warnings.
+    """
+    flags = np.zeros(len(batt_v), dtype=np.uint8)
+
+    # low battery warning
+    flags[((batt_v < _BATT_V_NORMAL) & (batt_v > _BATT_V_WARN)) |
+          ((batt_cap < _BATT_CAP_WARN) & (batt_cap > _BATT_CAP_DANGER))] |= _W_BATT_WARN
+    flags[(batt_v < _BATT_V_WARN) | (batt_cap < _BATT_CAP_DANGER)] |= _W_BATT_DANGER
+
+    # check if device is not sending data
+    flags[(delta_t > _TIME_S_WARN) & (delta_t < _TIME_S_DANGER)] |= _W_NO_MSG_WARN
+    flags[delta_t > _TIME_S_DANGER] |= _W_NO_MSG_DANGER
+
+    # check if cow is too far away from reference point
+    flags[(dist_m > _DIST_M_WARN) & (dist_m < _DIST_M_DANGER)] |= _W_TOO_FAR_WARN
+    flags[dist_m > _DIST_M_DANGER] |= _W_TOO_FAR_DANGER
+
+    return flags
+
+
+def _points_warning_flags(points: List[_PointRecord],
+                          dist_m: List[float],
+                          now_ts: Optional[float] = None) -> np.ndarray:
+    if now_ts is None:
+        now_ts = time.time()
+    batt_v = np.array([p.batt_v for p in points], dtype=np.float64)
+    batt_cap = np.array([p.batt_cap for p in points], dtype=np.float64)
+    delta_t = now_ts - np.array([p.timestamp for p in points], dtype=np.float64)
+    return _warning_flags(batt_v, batt_cap, delta_t, np.asarray(dist_m, dtype=np.float64))
+
+
 class DBException(Exception):
     class Code(Enum):
         E_UNSPECIFIED = auto()
@@ -213,39 +301,55 @@ class DBException(Exception):
         return f"{self.code.name} {self.message if self.message else ''}"
 
 
-class _Singleton(type):
-    _instances = {}
-
-    def __call__(cls, *args, **kwargs):
-        if cls not in cls._instances:
-            cls._instances[cls] = super(
-                _Singleton, cls).__call__(*args, **kwargs)
-        return cls._instances[cls]
-
-
-class Cows(metaclass=_Singleton):
+class Cows():
     CHECKUP_PERIOD_HOURS = 6
     NO_MSG_RECV_TIME_BTW_EMAILS_HOURS = 24
     LAST_MSG_TIME_S_WARN = 3600*3
+    MOVEMENT_CHECK_POINTS = 20
 
     def __init__(self):
         self._mapping: Optional[Mapping[str, int]] = None
         self._mapping_by_deveui: Optional[Mapping[str, int]] = None
+        self._names: Tuple[str, ...] = ()
+        self._deveuis: List[int] = []
+        self._mapping_task: Optional[asyncio.Future] = None
+        self.pool: Optional[Pool] = None
         self.email_sender: Optional[Email] = None
         self.cows_not_moving: Dict[str, _Warning] = {}
         # when the last email indicating that no messages were received was sent
         # initialized to an old date
-        self._last_no_msg_email_t: datetime = datetime(1, 1, 1)
+        self._last_no_msg_email_t: float = 0.0
 
     async def _create_name_deveui_mapping(self):
-        records = await Cows._map_names_to_deveuis()
+        async with self.pool.acquire() as conn:
+            records = await Cows._map_names_to_deveuis(conn)
         if len(records) > 0:
             self._mapping = {x['name']: x['deveui'] for x in records}
             self._mapping_by_deveui = {x['deveui']: x['name'] for x in records}
+            self._names = tuple(self._mapping)
+            self._deveuis = list(self._mapping.values())
+
+    async def _ensure_mapping(self):
+        """ Builds the name/deveui mapping if needed
+
+        Concurrent callers wait on the same query instead of issuing their own
+        """
+        if self._mapping is not None:
+            return
+        if self._mapping_task is None:
+            self._mapping_task = asyncio.ensure_future(
+                self._create_name_deveui_mapping())
+        task = self._mapping_task
+        try:
+            await asyncio.shield(task)
+        finally:
+            if self._mapping_task is task and task.done():
+                self._mapping_task = None
 
     async def aioinit(self, email_sender: Email):
         self.email_sender = email_sender
-        await self._create_name_deveui_mapping()
+        self.pool = await pool()
+        await self._ensure_mapping()
         # start periodic task
         loop = asyncio.get_event_loop()
         loop.create_task(
@@ -253,8 +357,7 @@ class Cows(metaclass=_Singleton):
 
     @staticmethod
     def _get_localtime() -> datetime:
-        now = datetime.utcnow()
-        return now.astimezone(_TZ)
+        return datetime.now(_TZ)
 
     async def _check_all_cows(self):
         """ Periodic checkup
@@ -263,47 +366,48 @@ class Cows(metaclass=_Singleton):
         warnings = []
         last_msg_received = 0
         last_msg_date = None
-        if self._mapping is None:
-            await self._create_name_deveui_mapping()
-
-        async with await connection() as conn:
-            for name in self._mapping:
-                deveui = self._mapping[name]
-                points = await Cows._get_last_coords_per_id(conn, deveui, 1)
-                if len(points) > 0:
-                    record = points[0]
-                    if record.timestamp > last_msg_received:
-                        last_msg_received = record.timestamp
-                        last_msg_date = record.localtime
-
-                    warns = record.get_warnings(to_json=False)
-                    if len(warns) > 0:
-                        warnings.append((name, warns))
-
-        now = datetime.utcnow().timestamp()
+        await self._ensure_mapping()
+
+        now = time.time()
+        async with self.pool.acquire() as conn:
+            records = await Cows._get_last_coords_bulk(conn, self._deveuis)
+
+        dists = Cows._point_distances_to_ref(records)
+        flags = _points_warning_flags(records, dists, now)
+        for record, dist_m, flags_ in zip(records, dists, flags):
+            name = self._mapping_by_deveui[record.deveui]
+            if record.timestamp > last_msg_received:
+                last_msg_received = record.timestamp
+                last_msg_date = record.localtime
+
+            warns = record.get_warnings(
+                to_json=False, dist_m=float(dist_m), flags=int(flags_))
+            if len(warns) > 0:
+                warnings.append((name, warns))
+
         if (now - last_msg_received) > self.LAST_MSG_TIME_S_WARN:
-            t_delta = datetime.now() - self._last_no_msg_email_t
-            if t_delta.total_seconds() / 3600 > self.NO_MSG_RECV_TIME_BTW_EMAILS_HOURS:
-                self._last_no_msg_email_t = datetime.now()
+            t_delta = now - self._last_no_msg_email_t
+            if t_delta / 3600 > self.NO_MSG_RECV_TIME_BTW_EMAILS_HOURS:
+                self._last_no_msg_email_t = now
                 logger.info(
                     f"Possible gateway error, no message received since: {last_msg_date}")
                 msg = f"Ningún mensaje recibido desde las: {last_msg_date.strftime('%H:%M %d-%m-%Y')}"
-                self.email_sender.send_email(
+                await self.email_sender.send_email_async(
                     "[REVISAR] No se están recibiendo mensajes", msg)
             return
 
         if len(warnings) == 0:
             return
 
-        msg = "Las siguientes alarmas requieren revisión:\n"
+        parts = ["Las siguientes alarmas requieren revisión:\n"]
         for name, warns in warnings:
-            msg += f"{name}:\n"
-            for w in warns:
-                msg += f"- {w}\n"
+            parts.append(f"{name}:\n")
+            parts.extend(f"- {w}\n" for w in warns)
+        msg = "".join(parts)
 
         logger.info(f"Warnings found in the periodic checkup {msg}")
         logger.info("Sending email")
-        self.email_sender.send_email("[REVISAR] Alarmas", msg)
+        await self.email_sender.send_email_async("[REVISAR] Alarmas", msg)
 
     async def _periodic_checkup(self, period: int):
         logger.info(f"scheduling periodic checkup with period {period}")
@@ -321,16 +425,32 @@ class Cows(metaclass=_Singleton):
         """ Checks if two points are approximately the same
         """
         acc = max(p1.accuracy, p2.accuracy)  # takes the largest accuracy
-        delta = geodist(p1.point, p2.point).meters
-        return delta < 2*acc
+        return _squared_meters(p1.point, p2.point) < (2*acc)**2
+
+    @staticmethod
+    def _distances_to_ref(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        """ Haversine distance in meters from each position to the reference point
+        """
+        lat1 = np.radians(lats)
+        dlat = _REF_LAT_RAD - lat1
+        dlon = _REF_LON_RAD - np.radians(lons)
+        a = np.sin(dlat/2)**2 + np.cos(lat1)*_COS_REF_LAT*np.sin(dlon/2)**2
+        return 2*_EARTH_RADIUS_M*np.arcsin(np.sqrt(a))
+
+    @staticmethod
+    def _point_distances_to_ref(points: List[_PointRecord]) -> np.ndarray:
+        coords = np.array([p.point for p in points],
+                          dtype=np.float64).reshape(-1, 2)
+        return Cows._distances_to_ref(coords[:, 0], coords[:, 1])
 
     async def check_cow_movement(self, deveui: int):
         """ Check if a cow is moving
 
         This function is called whenever a new record is stored to the database
         """
-        async with await connection() as conn:
-            points = await self._get_last_coords_per_id(conn, deveui, 20)
+        await self._ensure_mapping()
+        # the older points are only needed when the cow has not moved
+        points = await self._get_last_coords(deveui, 4, _POS_COLUMNS)
 
         n_points = len(points)
         if n_points > 3:
@@ -345,6 +465,10 @@ class Cows(metaclass=_Singleton):
                 logger.info(
                     f"Current position is the same as previous two p[0]: {p0.point}, p[-1]: {p1.point}, p[-2]: {p2.point}")
 
+                points += await self._get_last_coords(
+                    deveui, self.MOVEMENT_CHECK_POINTS - n_points, _POS_COLUMNS, n_points)
+                n_points = len(points)
+
                 i = 3
                 p = points[i]
                 while i < n_points and self._is_same_pos(p0, p):
@@ -368,7 +492,7 @@ class Cows(metaclass=_Singleton):
                     self.cows_not_moving[name] = _Warning(
                         _WarningType.COW_NOT_MOVING, _WarningVariant.DANGER, p.timestamp)
 
-                    self.email_sender.send_email(
+                    await self.email_sender.send_email_async(
                         f"[URGENTE] {name} no se está moviendo!", msg)
             else:
                 # clear warning
@@ -377,80 +501,109 @@ class Cows(metaclass=_Singleton):
                     del self.cows_not_moving[name]
 
     async def get_mapping(self) -> Mapping[str, int]:
-        if self._mapping is None:
-            await self._create_name_deveui_mapping()
+        await self._ensure_mapping()
         return self._mapping
 
     async def get_names(self) -> List[str]:
-        if self._mapping is None:
-            await self._create_name_deveui_mapping()
-        return [x for x in self._mapping.keys()]
+        await self._ensure_mapping()
+        return list(self._names)
 
     @staticmethod
     async def _get_last_coords_per_id(
         conn: Connection,
         deveui: int,
         n_points: Optional[int] = 1,
+        columns: Optional[str] = _MEAS_COLUMNS,
+        offset: Optional[int] = 0,
     ) -> List[Dict[str, Any]]:
 
         sql = f'''
-        SELECT * FROM meas WHERE deveui={deveui} 
-        ORDER BY t DESC LIMIT {n_points};
+        SELECT {columns} FROM meas WHERE deveui=$1
+        ORDER BY t DESC LIMIT $2 OFFSET $3;
         '''
-        records = await conn.fetch(sql)
+        records = await conn.fetch(sql, deveui, n_points, offset)
         points: List[_PointRecord] = []
 
         for r in records:
             points.append(_PointRecord(r))
         return points
 
+    async def _get_last_coords(self,
+                               deveui: int,
+                               n_points: Optional[int] = 1,
+                               columns: Optional[str] = _MEAS_COLUMNS,
+                               offset: Optional[int] = 0,
+                               ) -> List[_PointRecord]:
+        async with self.pool.acquire() as conn:
+            return await Cows._get_last_coords_per_id(conn, deveui, n_points, columns, offset)
+
+    @staticmethod
+    async def _get_last_coords_bulk(
+        conn: Connection,
+        deveuis: List[int],
+    ) -> List[_PointRecord]:
+        """ Fetches the last record of each device in a single query
+        """
+        sql = f'''
+        SELECT DISTINCT ON (deveui) {_MEAS_COLUMNS} FROM meas WHERE deveui = ANY($1)
+        ORDER BY deveui, t DESC;
+        '''
+        records = await conn.fetch(sql, deveuis)
+        return [_PointRecord(r) for r in records]
+
     async def get_last_coords(self,
                               name: str,
                               n_points: Optional[int] = 1,
                               ) -> List[Dict[str, Any]]:
 
+        await self._ensure_mapping()
         if name not in self._mapping:
             raise DBException(
                 f"Cow: {name} does exist in database", DBException.Code.E_UNKNOWN_COW)
 
-        async with await connection() as conn:
-            deveui = self._mapping[name]
-            points = await Cows._get_last_coords_per_id(conn, deveui, n_points)
-            if len(points) > 0:
-                no_mov_warn = self.cows_not_moving[name] if name in self.cows_not_moving else None
-                current_pos = points.pop(0).to_json(
-                    name=name, include_warnings=True, no_mov_warn=no_mov_warn)
+        points = await self._get_last_coords(self._mapping[name], n_points)
+        if len(points) > 0:
+            no_mov_warn = self.cows_not_moving[name] if name in self.cows_not_moving else None
+            current_pos = points.pop(0).to_json(
+                name=name, include_warnings=True, no_mov_warn=no_mov_warn)
 
-                if no_mov_warn is not None:
-                    logger.debug(
-                        f"Appending not moving warning to {name}: {no_mov_warn.to_json()}")
+            if no_mov_warn is not None:
+                logger.debug(
+                    f"Appending not moving warning to {name}: {no_mov_warn.to_json()}")
 
-                return [current_pos] + [p.to_json(name=name, include_warnings=False) for p in points]
-            else:
-                return []
+            return [current_pos] + [p.to_json(name=name, include_warnings=False) for p in points]
+        else:
+            return []
 
     async def get_current_pos_all_cows(self) -> List[Dict[str, Any]]:
+        await self._ensure_mapping()
         points = []
-        async with await connection() as conn:
-            # TODO: check if there is a more efficient way
-            for name in self._mapping:
-                deveui = self._mapping[name]
-                meas = await Cows._get_last_coords_per_id(conn, deveui, 1)
-                if len(meas) == 1:
-                    p = meas[0]
-                    no_mov_warn = self.cows_not_moving[name] if name in self.cows_not_moving else None
-                    if no_mov_warn is not None:
-                        logger.debug(
-                            f"Appending not moving warning to {name}: {no_mov_warn.to_json()}")
-                    points.append(
-                        p.to_json(name=name, no_mov_warn=no_mov_warn))
+        async with self.pool.acquire() as conn:
+            meas = await Cows._get_last_coords_bulk(
+                conn, self._deveuis)
+
+        dists = Cows._point_distances_to_ref(meas)
+        flags = _points_warning_flags(meas, dists)
+
+        for p, dist_m, flags_ in zip(meas, dists, flags):
+            name = self._mapping_by_deveui[p.deveui]
+            no_mov_warn = self.cows_not_moving[name] if name in self.cows_not_moving else None
+            if no_mov_warn is not None:
+                logger.debug(
+                    f"Appending not moving warning to {name}: {no_mov_warn.to_json()}")
+            points.append(
+                p.to_json(name=name, no_mov_warn=no_mov_warn,
+                          dist_m=float(dist_m), flags=int(flags_)))
 
         return points
 
     @staticmethod
-    async def _map_names_to_deveuis():
-        async with await connection() as conn:
-            sql = f'''
-            SELECT c.name, t.deveui FROM cows c INNER JOIN trackers t on t.label=c.label;
-            '''
-            return await conn.fetch(sql)
+    async def _map_names_to_deveuis(conn: Connection):
+        sql = '''
+        SELECT c.name, t.deveui FROM cows c INNER JOIN trackers t on t.label=c.label;
+        '''
+        return await conn.fetch(sql)
+
+
+# process wide instance, initialized from the server with aioinit
+cows_instance = Cows()
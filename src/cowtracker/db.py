@@ -17,15 +17,18 @@ T_dbdef = Union[str, Dict[str, Any]]
 _DB_URI: str = 'undefined_db_uri'
 _DB_NAME: str = 'pangote'
 DEFAULT_DBDEF: str = _DB_URI
-_CONFIG: Dict[str, Any] = {'dburi': DEFAULT_DBDEF}
+_POOL_SIZE: int = 20
+_CONFIG: Dict[str, Any] = {'dburi': DEFAULT_DBDEF, 'pool_size': _POOL_SIZE}
 _DBPOOL: Optional['_DbPool'] = None
+_PG_QUOTE_REGEX = re.compile("([\\\\'])")
 
 
-def conf_db_uri(host: str, user: str, port: str = '5432', db: str = _DB_NAME) -> str:
+def conf_db_uri(host: str, user: str, port: str = '5432', db: str = _DB_NAME,
+                pool_size: int = _POOL_SIZE) -> str:
     db_ = f'postgres://{user}@{host}:{port}/{db}'
     global _DB_URI, DEFAULT_DBDEF, _CONFIG
     _DB_URI = DEFAULT_DBDEF = db_
-    _CONFIG = {'dburi': DEFAULT_DBDEF}
+    _CONFIG = {'dburi': DEFAULT_DBDEF, 'pool_size': pool_size}
     return db_
 
 
@@ -38,8 +41,9 @@ async def db_stop() -> None:
 
 
 class _DbPool:
-    def __init__(self, dbdef: T_dbdef) -> None:
+    def __init__(self, dbdef: T_dbdef, max_size: int = _POOL_SIZE) -> None:
         self._dbdef = {'dsn': dbdef}
+        self._max_size = max_size
         self._pool: Optional[Pool] = None
 
     async def _init_pool_con(self, conn: Connection) -> None:
@@ -47,7 +51,11 @@ class _DbPool:
 
     async def get_pool(self) -> Pool:
         if not self._pool:
-            self._pool = await asyncpg.create_pool(**self._dbdef, init=self._init_pool_con, min_size=3)
+            # jit is off: the queries are small indexed lookups where JIT compilation only adds planning time
+            self._pool = await asyncpg.create_pool(**self._dbdef, init=self._init_pool_con,
+                                                   min_size=min(5, self._max_size), max_size=self._max_size,
+                                                   statement_cache_size=1024,
+                                                   server_settings={'jit': 'off'})
         return self._pool
 
     async def shutdown(self) -> None:
@@ -60,7 +68,8 @@ class _DbPool:
 def _lookup_dbpool() -> _DbPool:
     global _DBPOOL
     if _DBPOOL is None:
-        _DBPOOL = _DbPool(_CONFIG.get("dburi", DEFAULT_DBDEF))
+        _DBPOOL = _DbPool(_CONFIG.get("dburi", DEFAULT_DBDEF),
+                          _CONFIG.get("pool_size", _POOL_SIZE))
     return _DBPOOL
 
 
@@ -69,19 +78,21 @@ async def pool() -> Pool:
 
 
 class ConnCtx():
-    def __init__(self) -> None:
+    def __init__(self, transaction: bool = True) -> None:
         self.pool = None
         self.conn = None
         self.trans = None
+        self.transaction = transaction
 
     async def __aenter__(self) -> Connection:
         dbpool = self.pool = await pool()
         assert dbpool is not None
         conn = await dbpool.acquire()
         try:
-            trans = conn.transaction()
-            await trans.start()
-            self.trans = trans
+            if self.transaction:
+                trans = conn.transaction()
+                await trans.start()
+                self.trans = trans
         except Exception:
             try:
                 await dbpool.release(self.conn)
@@ -105,9 +116,13 @@ class ConnCtx():
 
 
 def pg_str(s: Optional[str]) -> str:
-    PG_QUOTE_REGEX = re.compile("([\\\\'])")
-    return 'NULL' if s is None else "E'"+PG_QUOTE_REGEX.sub(r'\\\1', s)+"'"
+    return 'NULL' if s is None else "E'"+_PG_QUOTE_REGEX.sub(r'\\\1', s)+"'"
 
 
-async def connection() -> ConnCtx:
-    return ConnCtx()
+async def connection(transaction: bool = True) -> ConnCtx:
+    """ Pooled connection context
+
+    With transaction=False statements run in autocommit mode, which saves the BEGIN/COMMIT
+    round-trips for read-only queries and single statements.
+    """
+    return ConnCtx(transaction)
@@ -1,17 +1,61 @@
+import asyncio
 import smtplib
 import ssl
+import threading
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 
 class Email():
+    TIMEOUT_S = 30
+
     def __init__(self, conf: Dict[str, Any]):
         self.user = conf['user']
         self.password = conf['password']
         self.to = conf['to']
         self.smtp_server = conf['smtp_server']
         self.port = conf['port']
+        # bounds every SMTP call, so a silently dropped session cannot hold _lock
+        self.timeout = conf.get('timeout', self.TIMEOUT_S)
+        # SMTP session kept open between emails, guarded by _lock
+        self._smtp: Optional[smtplib.SMTP] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> smtplib.SMTP:
+        context = ssl.create_default_context()
+        server = smtplib.SMTP(
+            self.smtp_server, self.port, timeout=self.timeout)
+        try:
+            server.starttls(context=context)
+            server.login(self.user, self.password)
+        except Exception:
+            server.close()
+            raise
+        return server
+
+    def _disconnect(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self._smtp.close()
+            self._smtp = None
+
+    def _get_server(self) -> smtplib.SMTP:
+        """ Returns the open SMTP session, reconnecting if the server dropped it
+        """
+        if self._smtp is not None:
+            try:
+                code, _ = self._smtp.noop()
+                if code == 250:
+                    return self._smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._disconnect()
+
+        self._smtp = self._connect()
+        return self._smtp
 
     def send_email(self, subject: str, content: str):
         msg = MIMEMultipart()
@@ -22,8 +66,19 @@ class Email():
 
         text = msg.as_string()
 
-        context = ssl.create_default_context()
-        with smtplib.SMTP(self.smtp_server, self.port) as server:
-            server.starttls(context=context)
-            server.login(self.user, self.password)
-            server.sendmail(self.user, self.to, text)
+        with self._lock:
+            self._get_server().sendmail(self.user, self.to, text)
+
+    async def send_email_async(self, subject: str, content: str):
+        """ Sends the email from a worker thread, without blocking the event loop
+        """
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.send_email, subject, content)
+
+    def _close(self):
+        with self._lock:
+            self._disconnect()
+
+    async def close(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._close)
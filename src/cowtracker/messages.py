@@ -1,178 +1,385 @@
+import asyncio
+import asyncpg  # type: ignore
 from base64 import b64decode
+from collections import deque
 from datetime import datetime
-from enum import Enum, auto
+from enum import IntFlag
+from functools import lru_cache
 import logging
-from typing import Dict, List
+import struct
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
 
-from cowtracker.db import connection
-from cowtracker.cows import Cows
+from cowtracker.db import pool
+from cowtracker.cows import cows_instance
 
 
 logger = logging.getLogger('messages')
 
-cows = Cows()  # global singleton
+_P136 = struct.Struct('<BBBII')
 
 
-class MessageStatus(Enum):
-    ERROR = auto()
-    NOFIX = auto()
-    INDOOR = auto()
+def _decode_136(b: bytes) -> Tuple:
+    """ Decodes the 11 bytes frame sent on port 136
 
+    Byte:   0       1        2      3 4 5 6   7 8 9 10
+    Field:  Status  Battery  Temp   Lat       Lon
 
-class Message():
-    def __init__(self, data: Dict[str, str]):
-        self.__data = data
+    Returns (flags, battery, batt_capacity, temperature, latitude, longitude, accuracy)
+    """
+    flags, batt, tempb, lat_raw, lonacc = _P136.unpack_from(b, 0)
 
-        try:
-            try:
-                self.dev_eui = int(
-                    self.__data['end_device_ids']['dev_eui'], 16) & 0xFFF
-            except Exception:
-                self.dev_eui = 0
+    # Byte 1: battery
+    # Bits[3:0] unsigned value ν, range 1 – 14, battery voltage in V = (25 + ν) ÷ 10.
+    # Bits [7:4] unsigned value κ, range 0 – 15 remaining battery capacity in % = 100 × (κ ÷ 15).
+    battery = ((batt & 0x0F) + 25) / 10.0
+    batt_capacity = (batt >> 4) * 100 / 15
 
-            self.__uplink_message = self.__data['uplink_message']
-            self.__settings = self.__uplink_message['settings']
+    # Byte 2: temperature
+    # Bits [6:0] unsigned value τ, range 0 – 127; temperature in °C = τ - 32
+    temperature = (tempb & 0x7F) - 32
 
-            try:
-                self.port = self.__uplink_message['f_port']
-            except Exception:
-                self.port = -1
+    # Byte 3-6: latitude (lsbf)
+    # Bits[27:0] signed value φ, range - 90, 000, 000 – 90, 000, 000; WGS84 latitude in ° = φ ÷ 1, 000, 000.
+    # Bits [31:28] RFU
+    lat = lat_raw & 0x0FFFFFFF
+    if lat & (1 << 27):
+        lat -= 1 << 28
 
-            self.__raw = self.__uplink_message['frm_payload']
-            self.__base64 = b64decode(self.__raw)
-        except Exception:
-            self.__base64 = None
-            logger.exception(f"Invalid message received: {self.__data}")
+    # Byte 7-10: longitude+accuracy (lsbf)
+    # Bits [28:0] signed value λ, range -179,999,999 – 180,000,000; WGS84 longitude in ° = λ ÷ 1,000,000.
+    # Bits [31:29] unsigned value α, range 0-7; position accuracy estimate in m = 2α + 2 (max).
+    # The value 7 represents an accuracy estimate of worse than 256m.
+    lon = lonacc & 0x1FFFFFFF
+    if lon & (1 << 28):
+        lon -= 1 << 29
+    # lonacc is an unsigned 32 bits word, so the shift alone leaves the 3 accuracy bits
+    accuracy = 2 * (lonacc >> 29) + 2
 
-        try:
-            self.__rssi = self.__uplink_message['rx_metadata'][0]['rssi']
-            self.__snr = self.__uplink_message['rx_metadata'][0]['snr']
-            self.__sf = self.__settings['data_rate']['lora']['spreading_factor']
-        except Exception:
-            logger.exception(
-                f"Couldn't extract rssi and snr from message: {self.__data}")
+    return flags, battery, batt_capacity, temperature, lat / 1000000, lon / 1000000, accuracy
+
+
+# column order of the rows built by Message.to_row
+_MEAS_COLUMNS = ('deveui', 't', 'pos', 'accuracy', 'batt_v',
+                 'batt_cap', 'temp', 'rssi', 'snr', 'sf')
+
+# errors after which the remaining rows are kept for the next flush
+_CONNECTION_ERRORS = (asyncpg.PostgresConnectionError,
+                      asyncpg.InterfaceError, OSError)
+
+# constant text, so asyncpg prepares it once per connection and reuses the plan
+_INSERT_MEAS = '''
+    INSERT INTO meas
+    (deveui, t, pos, accuracy, batt_v, batt_cap, temp, rssi, snr, sf)
+    VALUES
+    ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+'''
+
+
+# (minimum frame length, frame decoder) by port
+_DECODERS: Dict[int, Tuple[int, Callable[[bytes], Tuple]]] = {
+    136: (_P136.size, _decode_136),
+}
+
+
+class MessageStatus(IntFlag):
+    # Byte 0: status
+    # Bit 4: GSP module error
+    # Bit 3: no fix
+    # Bit 2: indoor
+    ERROR = 1 << 4
+    NOFIX = 1 << 3
+    INDOOR = 1 << 2
+
+
+@lru_cache(maxsize=1024)
+def _parse_deveui(dev_eui: str) -> int:
+    """ Tracker id from the dev_eui hex string; the herd is small, so this is cached
+    """
+    try:
+        # only the low 12 bits are kept, i.e. the last 3 hex digits
+        return int(dev_eui[-3:], 16) & 0xFFF
+    except (TypeError, ValueError):
+        return 0
+
+
+# status bits of byte 0 that map to MessageStatus
+_STATUS_MASK = MessageStatus.ERROR | MessageStatus.NOFIX | MessageStatus.INDOOR
+
+
+class Message():
+    __slots__ = ('_Message__raw', '_Message__base64', '_Message__payload',
+                 '_Message__rssi', '_Message__snr', '_Message__sf',
+                 'dev_eui', 'port', 'status', 'battery', 'batt_capacity',
+                 'temperature', 'latitude', 'longitude', 'accuracy')
+
+    def __init__(self, data: Dict[str, str]):
+        # data is not kept, only the fields below are needed after parsing
+        self.__base64 = None
+        self.__payload = None
+        uplink_message = data.get('uplink_message') or {}
+
+        self.dev_eui = _parse_deveui(
+            (data.get('end_device_ids') or {}).get('dev_eui'))
+        self.port = uplink_message.get('f_port', -1)
+        self.__raw = uplink_message.get('frm_payload')
+        if self.__raw is None:
+            logger.warning("Invalid message received: %s", data)
+
+        self.__sf = (((uplink_message.get('settings') or {})
+                      .get('data_rate') or {})
+                     .get('lora') or {}).get('spreading_factor')
+        rx_metadata = uplink_message.get('rx_metadata')
+        if not rx_metadata:
+            # not every gateway reports metadata, nothing to warn about
+            logger.debug("No rx_metadata in message: %s", data)
             self.__rssi = None
             self.__snr = None
-            self.__sf = None
+        else:
+            self.__rssi = rx_metadata[0].get('rssi')
+            self.__snr = rx_metadata[0].get('snr')
+            if self.__rssi is None or self.__snr is None:
+                logger.warning(
+                    "Couldn't extract rssi and snr from message: %s", data)
+
+    @property
+    def base64(self) -> Optional[bytes]:
+        """ Raw payload bytes, decoded on first access
+        """
+        if self.__base64 is None and self.__raw is not None:
+            try:
+                self.__base64 = b64decode(self.__raw)
+            except Exception:
+                logger.exception("Invalid payload received: %s", self.__raw)
+                self.__raw = None
+        return self.__base64
 
     @property
     def payload(self):
-        return f"0x{self.__base64.hex()}" if self.__base64 is not None else '0x000000'
+        if self.__payload is None:
+            base64 = self.base64
+            self.__payload = f"0x{base64.hex()}" if base64 is not None else '0x000000'
+        return self.__payload
 
     def __repr__(self):
         return f"{self.dev_eui}:{self.port} -> {self.payload}"
 
-    @staticmethod
-    def _signed(val: int, bits: int):
-        return val - (1 << bits) if val >= (1 << (bits - 1)) else val
+    def decode(self):
+        """
+        Decodes the message with the frame decoder registered for its port
+        """
+        entry = _DECODERS.get(self.port)
+        if entry is None:
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Skipping received message: %s on port %s.",
+                            self.payload, self.port)
+            return None
+
+        size, decoder = entry
+        buf = self.base64
+        if buf is None or len(buf) < size:
+            logger.warning("Skipping short frame: %s on port %s.",
+                           self.payload, self.port)
+            return None
 
-    @staticmethod
-    def _rdlsbf(bytes_: List, offset: int, length: int):
-        val = 0
-        offset += length - 1
-        while length:
-            val = val*256 + bytes_[offset]
-            offset -= 1
-            length -= 1
+        (flags, self.battery, self.batt_capacity, self.temperature,
+         self.latitude, self.longitude, self.accuracy) = decoder(buf)
 
-        return val
+        self.status = _STATUS_MASK & flags
 
-    def decode(self):
+        return {
+            "dev_eui": self.dev_eui,
+            "battery": self.battery,
+            "latitude": self.latitude,
+            "longitude": self.longitude,
+            "accuracy": self.accuracy,
+            "temp": self.temperature,
+            "status": self.status,
+            "rssi": self.__rssi,
+            "snr": self.__snr,
+            "sf": self.__sf
+        }
+
+    def to_row(self) -> Tuple:
+        """
+        Row for the meas table, in _MEAS_COLUMNS order
         """
-        Decodes message on port 136:
+        # batt_cap is an INT column; the server used to round the literal
+        return (self.dev_eui,
+                datetime.utcnow(),
+                (self.latitude, self.longitude),
+                self.accuracy,
+                self.battery,
+                round(self.batt_capacity),
+                self.temperature,
+                self.__rssi,
+                self.__snr,
+                self.__sf)
 
-        Byte:   0       1        2      3 4 5 6   7 8 9 10
-        Field:  Status  Battery  Temp   Lat       Lon
+
+class Recorder():
+    """ Buffers decoded rows and writes them to the db in bulk
+
+    A batch is flushed once BULK_SIZE rows are waiting or FLUSH_TIMEOUT_MS after
+    the previous flush, whichever comes first. While the db is unreachable the
+    rows stay buffered, up to MAX_BUFFERED, and the flush is retried with backoff.
+    """
+    BULK_SIZE = 64
+    FLUSH_TIMEOUT_MS = 100
+    MAX_BUFFERED = 64 * 1024
+    RETRY_MAX_S = 30
+
+    def __init__(self):
+        # the oldest rows are dropped once MAX_BUFFERED are waiting
+        self._buf: Deque[Tuple] = deque(maxlen=self.MAX_BUFFERED)
+        self._dropped = 0
+        self._failures = 0
+        self._full: Optional[asyncio.Event] = None
+        # serializes flushes, so close() waits for the one in progress
+        self._lock: Optional[asyncio.Lock] = None
+        # running movement checks by deveui, and the ones to run again once done
+        self._checks: Dict[int, asyncio.Task] = {}
+        self._rerun: Set[int] = set()
+
+    def submit(self, row: Tuple):
+        if len(self._buf) == self.MAX_BUFFERED:
+            self._count_dropped(1)
+        self._buf.append(row)
+        if len(self._buf) >= self.BULK_SIZE and self._full is not None:
+            self._full.set()
+
+    def _count_dropped(self, n: int):
+        if self._dropped == 0:
+            logger.warning(
+                "Buffer full with %d rows, dropping the oldest", self.MAX_BUFFERED)
+        self._dropped += n
+
+    def _requeue(self, rows: List[Tuple]):
+        """ Puts rows that were not written back in front of the newer ones
         """
-        if self.port == 136:
-            # Byte 0: status
-            # Bit 4: GSP module error
-            # Bit 3: no fix
-            # Bit 2: indoor
-            flags = self.__base64[0]
-            self.status = set()
-            if flags & (1 << 4):
-                self.status.add(MessageStatus.ERROR)
-            if flags & (1 << 3):
-                self.status.add(MessageStatus.NOFIX)
-            if flags & (1 << 2):
-                self.status.add(MessageStatus.INDOOR)
-
-            # Byte 1: battery
-            # Bits[3:0] unsigned value ν, range 1 – 14, battery voltage in V = (25 + ν) ÷ 10.
-            # Bits [7:4] unsigned value κ, range 0 – 15 remaining battery capacity in % = 100 × (κ ÷ 15).
-            self.battery = ((self.__base64[1] & 0x0F) + 25) / 10.0
-            self.batt_capacity = (self.__base64[1] >> 4) * 100 / 15
-
-            # Byte 2: temperature
-            # Bits [6:0] unsigned value τ, range 0 – 127; temperature in °C = τ - 32
-            self.temperature = (self.__base64[2] & 0x7F) - 32
-
-            # Byte 3-6: latitude (lsbf)
-            # Bits[27:0] signed value φ, range - 90, 000, 000 – 90, 000, 000; WGS84 latitude in ° = φ ÷ 1, 000, 000.
-            # Bits [31:28] RFU
-            self.latitude = Message._signed(Message._rdlsbf(
-                self.__base64, 3, 4) & 0x0FFFFFFF, 28) / 1000000
-
-            # Byte 7-10: longitude+accuracy (lsbf)
-            # Bits [28:0] signed value λ, range -179,999,999 – 180,000,000; WGS84 longitude in ° = λ ÷ 1,000,000.
-            # Bits [31:29] unsigned value α, range 0-7; position accuracy estimate in m = 2α + 2 (max).
-            # The value 7 represents an accuracy estimate of worse than 256m.
-            lonacc = Message._rdlsbf(self.__base64, 7, 4)
-            self.longitude = Message._signed(
-                lonacc & 0x1FFFFFFF, 29) / 1000000
-            self.accuracy = 2 * ((lonacc >> 29) & 0x7) + 2
-
-            return {
-                "dev_eui": self.dev_eui,
-                "battery": self.battery,
-                "latitude": self.latitude,
-                "longitude": self.longitude,
-                "accuracy": self.accuracy,
-                "temp": self.temperature,
-                "status": self.status,
-                "rssi": self.__rssi,
-                "snr": self.__snr,
-                "sf": self.__sf
-            }
-        else:
-            logger.info(
-                f"Skipping received message: {self.payload} on port {self.port}.")
+        room = self.MAX_BUFFERED - len(self._buf)
+        if len(rows) > room:
+            self._count_dropped(len(rows) - room)
+            rows = rows[len(rows) - room:]
+        self._buf.extendleft(reversed(rows))
+
+    async def run(self):
+        # created here so that they are bound to the running loop
+        self._full = asyncio.Event()
+        self._lock = asyncio.Lock()
+        timeout = self.FLUSH_TIMEOUT_MS / 1000
+        delay = timeout
+        while True:
+            if self._failures:
+                # a full buffer would set _full right away, so just back off
+                await asyncio.sleep(delay)
+            else:
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+            if not self._buf:
+                continue
 
-    async def store(self):
+            try:
+                # a cancel must not cut a write that the db may have committed
+                await asyncio.shield(self._locked_flush())
+            except Exception:
+                # logged once per outage, the rows stay buffered for the retry
+                if self._failures == 0:
+                    logger.exception(
+                        "Error writing to db, keeping %d rows until it recovers", len(self._buf))
+                self._failures += 1
+                delay = min(delay * 2, self.RETRY_MAX_S)
+                continue
+
+            if self._failures:
+                logger.info("Writes to db resumed after %d failed attempts", self._failures)
+                self._failures = 0
+                delay = timeout
+            if self._dropped:
+                logger.warning("%d rows were dropped while the db was unreachable", self._dropped)
+                self._dropped = 0
+
+    async def _locked_flush(self):
+        async with self._lock:
+            await self.flush()
+
+    async def close(self):
+        """ Writes the rows still buffered and waits for the movement checks
+
+        Any flush still in progress when run() was cancelled completes first.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._buf:
+                try:
+                    await self.flush()
+                except Exception:
+                    logger.exception(
+                        "Error writing to db, %d buffered rows are lost", len(self._buf))
+        if self._checks:
+            await asyncio.gather(*self._checks.values(), return_exceptions=True)
+
+    async def flush(self):
+        """ Writes the buffered rows, the ones not written are put back in the buffer
         """
-        Store message to db
+        batch = list(self._buf)
+        self._buf.clear()
+        written = 0
+        stored: Set[int] = set()
+
+        try:
+            dbpool = await pool()
+            async with dbpool.acquire() as conn:
+                try:
+                    await conn.copy_records_to_table(
+                        'meas', records=batch, columns=_MEAS_COLUMNS)
+                    written = len(batch)
+                    stored.update(row[0] for row in batch)
+                except _CONNECTION_ERRORS:
+                    raise
+                except Exception:
+                    logger.exception(
+                        "Bulk insert of %d rows failed, storing them one by one", len(batch))
+                    for row in batch:
+                        try:
+                            await conn.execute(_INSERT_MEAS, *row)
+                            stored.add(row[0])
+                        except _CONNECTION_ERRORS:
+                            raise
+                        except Exception:
+                            logger.exception("Error storing row to db: %s", row)
+                        written += 1
+        finally:
+            if written < len(batch):
+                self._requeue(batch[written:])
+            # also for the rows stored before a failure
+            for deveui in stored:
+                self._trigger_check(deveui)
+
+    def _trigger_check(self, deveui: int):
+        """ Runs the movement check of a device, without holding up the next flush
         """
-        async with await connection() as conn:
-            sql = f'''
-            INSERT INTO meas
-            (
-                deveui,
-                t,
-                pos,
-                accuracy,
-                batt_v,
-                batt_cap,
-                temp,
-                rssi,
-                snr,
-                sf
-            )
-            VALUES
-            (
-                {self.dev_eui},
-                '{datetime.utcnow()}',
-                '({self.latitude}, {self.longitude})',
-                {self.accuracy},
-                {self.battery if self.battery else 'NULL'},
-                {self.batt_capacity if self.batt_capacity else 'NULL'},
-                {self.temperature if self.temperature else 'NULL'},
-                {self.__rssi if self.__rssi else 'NULL'},
-                {self.__snr if self.__snr else 'NULL'},
-                {self.__sf if self.__sf else 'NULL'}
-            );
-            '''
-            await conn.execute(sql)
-
-            # trigger cow movement check
-            await cows.check_cow_movement(self.dev_eui)
+        if deveui in self._checks:
+            # the running check may have read the points before the new row
+            self._rerun.add(deveui)
+        else:
+            self._checks[deveui] = asyncio.create_task(self._check_movement(deveui))
+
+    async def _check_movement(self, deveui: int):
+        try:
+            while True:
+                self._rerun.discard(deveui)
+                try:
+                    await cows_instance.check_cow_movement(deveui)
+                except Exception:
+                    logger.exception("Error checking movement of %s", deveui)
+                if deveui not in self._rerun:
+                    break
+        finally:
+            del self._checks[deveui]
+
+
+recorder = Recorder()
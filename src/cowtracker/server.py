@@ -1,25 +1,41 @@
 from aiohttp import web
 import argparse
 import asyncio
+import hashlib
 import logging
 import logging.config
 from pathlib import Path
 import os
-from typing import Dict, Optional
+import signal
+from typing import Dict, Optional, Tuple
 import yaml
 
 from cowtracker.db import conf_db_uri, db_stop
 from cowtracker.ttn import TTNClient
-from cowtracker.cows import Cows, set_warn_levels
+from cowtracker.cows import cows_instance, set_warn_levels
 from cowtracker.email import Email
+from cowtracker.messages import recorder
+
+try:
+    from orjson import dumps as _dumps
+except ImportError:
+    import ujson
+
+    def _dumps(data) -> bytes:
+        return ujson.dumps(data).encode()
 
 logger = logging.getLogger('server')
 
 # global variables
 routes = web.RouteTableDef()
 app = web.Application()
-cows_obj = Cows()
 frontend_folder: Optional[str] = None
+# index.html body and its ETag, read once at startup
+index_page: Optional[Tuple[bytes, str]] = None
+
+
+def _json_response(data) -> web.Response:
+    return web.Response(body=_dumps(data), content_type='application/json')
 
 
 # ------------------------------------------------------------
@@ -28,14 +44,17 @@ frontend_folder: Optional[str] = None
 
 @routes.get('/')
 async def ui_home(request):
-    return web.FileResponse(
-        os.path.join(frontend_folder, "index.html"))
+    body, etag = index_page
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if request.headers.get('If-None-Match') == etag:
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type='text/html', headers=headers)
 
 
 @routes.get('/api/v1/names')
 async def handler_get_cow_names(request):
-    data = await cows_obj.get_names()
-    return web.json_response(data)
+    data = await cows_instance.get_names()
+    return _json_response(data)
 
 
 @routes.get('/api/v1/meas/{name}')
@@ -43,16 +62,16 @@ async def handler_meas(request):
     cow = request.match_info['name']
     if cow != 'all':
         try:
-            data = await cows_obj.get_last_coords(cow, 10)
-            return web.json_response(data)
+            data = await cows_instance.get_last_coords(cow, 10)
+            return _json_response(data)
         except Exception:
             raise web.HTTPBadRequest()
     else:
-        data = await cows_obj.get_current_pos_all_cows()
-        return web.json_response(data)
+        data = await cows_instance.get_current_pos_all_cows()
+        return _json_response(data)
 
 
-async def web_start(config_nginx: Dict, dev_mode: bool):
+async def web_start(config_nginx: Dict, dev_mode: bool) -> web.AppRunner:
     app.router.add_static('/static', path=frontend_folder)
     app.add_routes(routes)
     app.on_cleanup.append(on_cleanup)
@@ -67,10 +86,15 @@ async def web_start(config_nginx: Dict, dev_mode: bool):
         site = web.UnixSite(
             runner, socket, ssl_context=None)
     await site.start()
+    return runner
 
 
 async def on_cleanup(app):
     logger.info("On cleanup")
+    # buffered rows are written while the pool and email sender are still open
+    await recorder.close()
+    if cows_instance.email_sender is not None:
+        await cows_instance.email_sender.close()
     await db_stop()
 
 
@@ -105,7 +129,8 @@ async def main():
     conf_db_uri(pg_conf['host'],
                 pg_conf['user'],
                 pg_conf['port'],
-                pg_conf['database']
+                pg_conf['database'],
+                pg_conf.get('pool_size', 20)
                 )
 
     try:
@@ -118,10 +143,12 @@ async def main():
 
     email_conf = config['email']
     email_sender = Email(email_conf)
-    await cows_obj.aioinit(email_sender)
+    await cows_instance.aioinit(email_sender)
 
-    global frontend_folder
+    global frontend_folder, index_page
     frontend_folder = config['frontend_folder']
+    index_body = Path(frontend_folder, 'index.html').read_bytes()
+    index_page = (index_body, f'"{hashlib.md5(index_body).hexdigest()}"')
 
     dev_mode: bool = True
     try:
@@ -133,10 +160,21 @@ async def main():
     if 'dev_mode' in config:
         dev_mode = config['dev_mode']
 
-    await asyncio.gather(
-        web_start(config_nginx, dev_mode),
-        ttn_client.run_retry(topics)
-    )
+    # SIGTERM (systemd stop) cancels main, so that the cleanup below runs
+    asyncio.get_event_loop().add_signal_handler(
+        signal.SIGTERM, asyncio.current_task().cancel)
+
+    runner = await web_start(config_nginx, dev_mode)
+    try:
+        # the recorder outlives the MQTT sessions, which are restarted on disconnects
+        await asyncio.gather(
+            ttn_client.run_retry(topics),
+            recorder.run()
+        )
+    except asyncio.CancelledError:
+        logger.info("Shutting down")
+    finally:
+        await runner.cleanup()
 
 if __name__ == '__main__':
     asyncio.run(main())
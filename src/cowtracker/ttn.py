@@ -5,15 +5,23 @@ from contextlib import AsyncExitStack
 import logging
 import ssl
 from typing import Dict, Optional, Tuple
-import ujson
 
-from cowtracker.messages import Message
+try:
+    # parses the bytes payload directly
+    from orjson import loads as json_loads
+except ImportError:
+    from ujson import loads as json_loads
+
+from cowtracker.messages import Message, recorder
 
 
 logger = logging.getLogger('ttn')
 
 
 class TTNClient():
+    INBOX_SIZE = 1024
+    DECODE_BATCH_SIZE = 32
+
     def __init__(self, config: Dict[str, str], tls_context: ssl.SSLContext):
         self.__hostname = config['host']
         self.__port = config['port']
@@ -31,14 +39,14 @@ class TTNClient():
             stack.push_async_callback(self.cancel_tasks, self.tasks)
             await stack.enter_async_context(self.__client)
 
-            for topic_filter in topics:
-                # Log all messages that matches the filter
-                manager = self.__client.filtered_messages(topic_filter)
-                messages = await stack.enter_async_context(manager)
-                template = f'[topic_filter="{topic_filter}"] {{}}'
-                task = asyncio.create_task(
-                    self.log_messages(messages, template))
-                self.tasks.add(task)
+            self._inbox = asyncio.Queue(self.INBOX_SIZE)
+            self.tasks.add(asyncio.create_task(self._decode_worker()))
+
+            # Only the uplink topics are subscribed, so a single unfiltered
+            # subscriber sees exactly those messages without per-filter matching
+            manager = self.__client.unfiltered_messages()
+            messages = await stack.enter_async_context(manager)
+            self.tasks.add(asyncio.create_task(self.log_messages(messages)))
 
             for topic in topics:
                 await self.__client.subscribe(topic)
@@ -61,29 +69,50 @@ class TTNClient():
             logger.info(f'[topic="{topic}"] Publishing message={message}')
             await self.__client.publish(topic, message, qos=1)
 
-    async def log_messages(self, messages, template):
+    async def log_messages(self, messages):
         async for msg in messages:
+            await self._inbox.put(msg.payload)
+
+    async def _decode_worker(self):
+        """ Decodes and stores the payloads queued by log_messages
+        """
+        while True:
+            batch = [await self._inbox.get()]
+            while len(batch) < self.DECODE_BATCH_SIZE and not self._inbox.empty():
+                batch.append(self._inbox.get_nowait())
+
+            for payload in batch:
+                self._handle_payload(payload)
+
+    def _handle_payload(self, payload: bytes):
+        """ Decodes one payload and hands the row to the recorder, never waits on the db
+        """
+        try:
+            data = json_loads(payload)
+        except ValueError:
+            logger.warning("Invalid message received: %s", payload)
+            return
+
+        try:
+            uplink = Message(data)
+            logger.info("Got uplink message %s", uplink)
             try:
-                payload = msg.payload
-                uplink = Message(ujson.loads(payload.decode()))
-                logger.info(f"Got uplink message {uplink}")
+                message = uplink.decode()
                 try:
-                    message = uplink.decode()
-                    try:
-                        if message is not None:
-                            logger.info(f"Decoded message: {message}")
-                            if len(message['status']) > 0:
-                                logger.info(
-                                    f"Not storing message with status: {message['status']} to db.")
-                            else:
-                                await uplink.store()
-                    except Exception:
-                        logger.exception(
-                            f"Error storing message to db: {message}")
+                    if message is not None:
+                        logger.info("Decoded message: %s", message)
+                        if message['status']:
+                            logger.info(
+                                "Not storing message with status: %s to db.", message['status'])
+                        else:
+                            recorder.submit(uplink.to_row())
                 except Exception:
-                    logger.exception(f"Error decoding message {uplink}")
+                    logger.exception(
+                        "Error storing message to db: %s", message)
             except Exception:
-                logger.exception(f"Invalid message received: {msg.payload}")
+                logger.exception("Error decoding message %s", uplink)
+        except Exception:
+            logger.exception("Invalid message received: %s", payload)
 
     async def cancel_tasks(self, tasks):
         for task in tasks: